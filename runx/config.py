@@ -9,3 +9,10 @@ cfg = __C
 __C.FARM = None
 __C.LOGROOT = None
 __C.EXP_NAME = None
+
+# Number of farm submissions that runx stages and submits concurrently
+__C.DISPATCH_WORKERS = 16
+
+# Hardlink the code of farm runs against a read-only snapshot rather than
+# giving every run its own writable copy
+__C.LINK_CODE = False
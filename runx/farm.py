@@ -36,6 +36,22 @@ from .config import cfg
 from .utils import exec_cmd
 
 
+def _fmt_bool(field, val):
+    return f'--{field}' if val else ''
+
+
+def _fmt_seq(field, val):
+    return ' '.join(f'--{field} {v}' for v in val)
+
+
+def _fmt_scalar(field, val):
+    return f'--{field} {val}'
+
+
+# How each type of resource value is rendered into submission args
+_RESOURCE_FORMATTERS = {bool: _fmt_bool, list: _fmt_seq, tuple: _fmt_seq}
+
+
 def expand_resources(resources):
     """
     Construct the submit_job arguments from the resource dict.
@@ -47,17 +63,10 @@ def expand_resources(resources):
 
     :resources: a dict of arguments for the farm submission command.
     """
-    cmd = ''
-    for field, val in resources.items():
-        if type(val) is bool:
-            if val is True:
-                cmd += '--{} '.format(field)
-        elif type(val) is list or type(val) is tuple:
-            for mp in val:
-                cmd += '--{} {} '.format(field, mp)
-        else:
-            cmd += '--{} {} '.format(field, val)
-    return cmd
+    get_fmt = _RESOURCE_FORMATTERS.get
+    cmd = ' '.join(filter(None, (get_fmt(type(val), _fmt_scalar)(field, val)
+                                 for field, val in resources.items())))
+    return cmd + ' ' if cmd else cmd
 
 
 def build_draco(train_cmd, job_name, resources, logdir):
@@ -68,12 +77,9 @@ def build_draco(train_cmd, job_name, resources, logdir):
     """
     assert 'submit_job' in cfg.SUBMIT_CMD, \
         'Expected \'submit_job\' as SUBMIT_CMD. Exiting ...'
-    submit_cmd = cfg.SUBMIT_CMD + ' '
-    submit_cmd += expand_resources(resources)
-    submit_cmd += f' --name {job_name}'
-    submit_cmd += f' --command \' {train_cmd} \''
-    submit_cmd += f' --logdir {logdir}/gcf_log'
-    return submit_cmd
+    return (f'{cfg.SUBMIT_CMD} {expand_resources(resources)} '
+            f'--name {job_name} --command \' {train_cmd} \' '
+            f'--logdir {logdir}/gcf_log')
 
 
 def build_ngc_generic(train_cmd, job_name, resources, logdir):
@@ -87,12 +93,9 @@ def build_ngc_generic(train_cmd, job_name, resources, logdir):
     """
     assert cfg.SUBMIT_CMD == 'ngc batch run', \
         'Expected SUBMIT_CMD to be \'ngc batch run\'. Exiting ...'
-    submit_cmd = cfg.SUBMIT_CMD + ' '
-    submit_cmd += expand_resources(resources)
-    submit_cmd += f' --name {job_name}'
-    submit_cmd += f' --commandline \' {train_cmd} \''
-    submit_cmd += f' --workspace {cfg.WORKSPACE}:{cfg.NGC_LOGROOT}:RW'
-    return submit_cmd
+    return (f'{cfg.SUBMIT_CMD} {expand_resources(resources)} '
+            f'--name {job_name} --commandline \' {train_cmd} \' '
+            f'--workspace {cfg.WORKSPACE}:{cfg.NGC_LOGROOT}:RW')
 
 
 def build_ngc(train_cmd, job_name, resources, logdir):
@@ -136,7 +139,7 @@ def build_farm_cmd(train_cmd, job_name, resources, logdir):
     elif 'draco' in cfg.FARM:
         return build_draco(train_cmd, job_name, resources, logdir)
     else:
-        raise f'Unsupported farm: {cfg.FARM}'
+        raise ValueError(f'Unsupported farm: {cfg.FARM}')
 
 
 def upload_to_ngc(staging_logdir):
@@ -154,10 +157,8 @@ def upload_to_ngc(staging_logdir):
 
     ngc_workspace = cfg.WORKSPACE
     target_dir = os.path.join(exp_name, run_name)
-    msg = 'Uploading experiment to {} in workpace {} ...'
-    print(msg.format(target_dir, ngc_workspace))
-    cmd = ('ngc workspace upload --source {staging_logdir} '
-           '--destination {target_dir} {workspace}')
-    cmd = cmd.format(staging_logdir=staging_logdir, target_dir=target_dir,
-                     workspace=ngc_workspace)
+    print(f'Uploading experiment to {target_dir} in workpace '
+          f'{ngc_workspace} ...')
+    cmd = ['ngc', 'workspace', 'upload', '--source', staging_logdir,
+           '--destination', target_dir, ngc_workspace]
     exec_cmd(cmd)
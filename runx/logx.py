@@ -27,11 +27,15 @@ CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from itertools import chain
 from shutil import copyfile
 
+import atexit
+import copy
 import csv
+import json
 import os
 import re
 import shlex
@@ -55,21 +59,96 @@ except ImportError:
                        ConditionalProxy)
 
 
+# Batched metrics.csv rows are flushed by the next metric() call once they
+# are this old, in seconds. There's no timer, so without further metric()
+# calls they wait for flush() or the LogX going away.
+_CSV_FLUSH_SECS = 5.0
+
+# Filenames of best checkpoints, as written by LogX.save_model
+_BEST_CKPT_RE = re.compile(r'^best_checkpoint_ep([0-9]+)\.pth$')
+
+# Sidecar file recording the metric/epoch of the best checkpoint, so that
+# resuming doesn't require loading the checkpoint itself
+_BEST_METRIC_FN = '.best_metric.json'
+
+
 def is_list(x):
     return isinstance(x, (list, tuple))
 
 
+# pynvml module and GPU 0 handle, set up on first use by _get_nvml()
+_nvml = None
+_nvml_handle = None
+_nvml_initialized = False
+
+# Last (time, value) sampled from nvidia-smi, reused for _GPU_UTIL_TTL seconds
+_GPU_UTIL_TTL = 0.1
+_gpu_util_sample = [float('-inf'), 0]
+
+
+def _get_nvml():
+    '''
+    Lazily initialize NVML. Returns the pynvml module and a handle to GPU 0,
+    or (None, None) if pynvml isn't installed or NVML isn't usable.
+    '''
+    global _nvml, _nvml_handle, _nvml_initialized
+    if not _nvml_initialized:
+        _nvml_initialized = True
+        try:
+            import pynvml
+            pynvml.nvmlInit()
+            atexit.register(pynvml.nvmlShutdown)
+            _nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+            _nvml = pynvml
+        except Exception:
+            _nvml, _nvml_handle = None, None
+    return _nvml, _nvml_handle
+
+
+def _snapshot(obj):
+    '''
+    Make a CPU copy of all of the tensors in a (possibly nested) checkpoint
+    dict, so that it can be written out while training keeps updating the
+    original tensors.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        # copy.copy keeps the dict type along with any attributes, such as
+        # the `_metadata` that torch attaches to state dicts
+        snapshot = copy.copy(obj)
+        for k, v in snapshot.items():
+            snapshot[k] = _snapshot(v)
+        return snapshot
+    if type(obj) in (list, tuple):
+        return type(obj)(_snapshot(v) for v in obj)
+    return obj
+
+
 def get_gpu_utilization_pct():
     '''
-    Use nvidia-smi to capture the GPU utilization, which is reported as an
-    integer in range 0-100.
+    Capture the GPU utilization, which is reported as an integer in range
+    0-100.
+
+    NVML is queried directly when pynvml is available, which avoids
+    launching nvidia-smi on every call. Otherwise fall back to nvidia-smi,
+    whose result is reused for calls made within _GPU_UTIL_TTL seconds.
     '''
+    nvml, handle = _get_nvml()
+    if nvml is not None:
+        return int(nvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+
+    now = time.monotonic()
+    if now - _gpu_util_sample[0] < _GPU_UTIL_TTL:
+        return _gpu_util_sample[1]
+
     util = subprocess.check_output(
         shlex.split('nvidia-smi --query-gpu="utilization.gpu" '
                     '--format=csv,noheader,nounits -i 0'))
     util = util.decode('utf-8')
     util = util.replace('\n', '')
-    return int(util)
+    _gpu_util_sample[:] = [now, int(util)]
+    return _gpu_util_sample[1]
 
 
 class LogX(object):
@@ -78,7 +157,7 @@ class LogX(object):
 
     def initialize(self, logdir=None, coolname=False, hparams=None,
                    tensorboard=False, no_timestamp=False, global_rank=0,
-                   eager_flush=True):
+                   eager_flush=True, async_save=False):
         '''
         Initialize logx
 
@@ -92,6 +171,8 @@ class LogX(object):
         - hparams - only use if not launching jobs with runx, which also saves
           the hparams.
         - eager_flush - call `flush` after every tensorboard write
+        - async_save - write checkpoints from a background thread, so that
+          save_model returns as soon as the checkpoint is copied to cpu
         '''
         self.rank0 = (global_rank == 0)
         self.initialized = True
@@ -107,8 +188,7 @@ class LogX(object):
                 self.logdir = os.path.join(logroot, 'default')
 
         # confirm target log directory exists
-        if not os.path.isdir(self.logdir):
-            os.makedirs(self.logdir, exist_ok=True)
+        os.makedirs(self.logdir, exist_ok=True)
 
         if hparams is not None and self.rank0:
             save_hparams(hparams, self.logdir)
@@ -140,11 +220,23 @@ class LogX(object):
         metrics_fn = os.path.join(self.logdir, 'metrics.csv')
         self.metrics_fp = open(metrics_fn, mode='a+')
         self.metrics_writer = csv.writer(self.metrics_fp, delimiter=',')
+        # Validation rows can be written in batches: a metric() call flushes
+        # once `LOGX_CSV_FLUSH` rows are buffered or the last flush is more
+        # than _CSV_FLUSH_SECS seconds ago
+        self._csv_rows = []
+        self._csv_flush_every = int(os.environ.get('LOGX_CSV_FLUSH', '1'))
+        self._csv_last_flush = time.monotonic()
+        self._csv_batching = False
 
         # Log file
         log_fn = os.path.join(self.logdir, 'logging.log')
         self.log_file = open(log_fn, mode='a+')
 
+        # At most one checkpoint write is in flight when saving asynchronously
+        self._save_pool = ThreadPoolExecutor(max_workers=1) \
+            if async_save else None
+        self._save_future = None
+
         # save metric
         self.save_metric = None
         self.best_metric = None
@@ -153,9 +245,8 @@ class LogX(object):
         # if available
         self.best_ckpt_fn = self.get_best_checkpoint() or ''
         if self.best_ckpt_fn:
-            best_chk = torch.load(self.best_ckpt_fn, map_location='cpu')
-            self.best_metric = best_chk.get('__metric', None)
-        self.epoch = defaultdict(lambda: 0)
+            self.best_metric = self._read_best_metric()
+        self.epoch = {'train': 0, 'val': 0}
         self.no_timestamp = no_timestamp
 
         # Initial timestamp, so that epoch time calculation is correct
@@ -177,6 +268,11 @@ class LogX(object):
 
     def __del__(self):
         if self.initialized and self.rank0:
+            self.wait_for_save()
+            # When collected during interpreter shutdown, the files may
+            # already have been finalized
+            if not self.metrics_fp.closed:
+                self.flush()
             self.metrics_fp.close()
             self.log_file.close()
 
@@ -203,6 +299,46 @@ class LogX(object):
         '''
         self.tensorboard.add_scalar(name, val, idx)
 
+    def flush(self):
+        '''
+        Write any buffered validation rows out to metrics.csv. This doesn't
+        flush tensorboard.
+        '''
+        if not self.initialized or not self.rank0:
+            return
+
+        if self._csv_rows:
+            self.metrics_writer.writerows(self._csv_rows)
+            self._csv_rows.clear()
+        self.metrics_fp.flush()
+        self._csv_last_flush = time.monotonic()
+
+    def _maybe_flush_metrics(self):
+        if self._csv_batching:
+            return
+        if len(self._csv_rows) >= self._csv_flush_every or \
+           time.monotonic() - self._csv_last_flush >= _CSV_FLUSH_SECS:
+            self.flush()
+
+    @contextmanager
+    def csv_batch(self):
+        '''
+        Defer all metrics.csv flushes until the end of the block
+        '''
+        if not self.initialized or not self.rank0:
+            yield
+            return
+
+        prev_batching = self._csv_batching
+        self._csv_batching = True
+        try:
+            yield
+        finally:
+            # even if the block raised, the rows logged so far must still
+            # reach metrics.csv
+            self._csv_batching = prev_batching
+            self.flush()
+
     def _flush_tensorboard(self):
         if self.eager_flush and self.tb_writer is not None:
             self.tb_writer.flush()
@@ -235,43 +371,77 @@ class LogX(object):
         elif phase in val_names:
             canonical_phase = 'val'
         else:
-            raise('expected phase to be one of {} {}'.format(str(val_names,
-                                                                 trn_names)))
+            raise ValueError('expected phase to be one of {} {}'.format(
+                val_names, trn_names))
 
         if epoch is not None:
             self.epoch[canonical_phase] = epoch
+        ep = self.epoch[canonical_phase]
 
         # Record metrics to csv file
         csv_line = [canonical_phase]
-        for k, v in metrics.items():
-            csv_line.append(k)
-            csv_line.append(v)
+        csv_line.extend(chain.from_iterable(metrics.items()))
 
         # add epoch/iter
-        csv_line.append('epoch')
-        csv_line.append(self.epoch[canonical_phase])
+        csv_line += ['epoch', ep]
 
         # add timestamp
         if not self.no_timestamp:
             # this feature is useful for testing
-            csv_line.append('timestamp')
-            csv_line.append(time.time())
+            csv_line += ['timestamp', time.time()]
 
         # To save a bit of disk space, only save validation metrics
         if canonical_phase == 'val':
-            self.metrics_writer.writerow(csv_line)
-            self.metrics_fp.flush()
-
-        # Write updates to tensorboard file
-        with self.suspend_flush():
-            for k, v in metrics.items():
-                self.add_scalar('{}/{}'.format(phase, k), v,
-                                self.epoch[canonical_phase])
+            self._csv_rows.append(csv_line)
+            self._maybe_flush_metrics()
+
+        # Write updates to tensorboard file. All of the scalars for this step
+        # are written with a single flush at the end. We've already checked
+        # rank0 and tb_writer here, so write to the SummaryWriter directly
+        # rather than going through the proxy for every scalar.
+        tbw = self.tb_writer
+        if tbw is not None:
+            with self.suspend_flush():
+                for k, v in metrics.items():
+                    tbw.add_scalar('{}/{}'.format(phase, k), v, ep)
 
         # if no step, then keep track of it automatically
         if epoch is None:
             self.epoch[canonical_phase] += 1
 
+    def _read_best_metric(self):
+        '''
+        Recover the metric of `self.best_ckpt_fn`, preferably from the small
+        sidecar file written by save_model. Falls back to loading the
+        checkpoint for logdirs written before the sidecar existed, or if the
+        sidecar doesn't describe this checkpoint.
+        '''
+        epoch = int(_BEST_CKPT_RE.fullmatch(
+            os.path.basename(self.best_ckpt_fn)).group(1))
+        try:
+            with open(os.path.join(self.logdir, _BEST_METRIC_FN)) as fp:
+                best = json.load(fp)
+            if best['epoch'] == epoch:
+                return best['metric']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        best_chk = torch.load(self.best_ckpt_fn, map_location='cpu')
+        return best_chk.get('__metric', None)
+
+    def _write_best_metric(self, metric, epoch):
+        sidecar_fn = os.path.join(self.logdir, _BEST_METRIC_FN)
+        try:
+            best = json.dumps({'metric': metric, 'epoch': epoch})
+        except TypeError:
+            # Metric isn't json serializable (e.g. a tensor), so remove any
+            # stale sidecar and let resumption fall back to the checkpoint
+            if os.path.exists(sidecar_fn):
+                os.remove(sidecar_fn)
+            return
+        with open(sidecar_fn, 'w') as fp:
+            fp.write(best)
+
     @staticmethod
     def is_better(save_metric, best_metric, higher_better):
         return best_metric is None or \
@@ -298,25 +468,68 @@ class LogX(object):
 
         save_dict['__metric'] = metric
 
-        if os.path.exists(self.save_ckpt_fn) and delete_old:
-            os.remove(self.save_ckpt_fn)
-        # Save out current model
+        prev_save_fn = self.save_ckpt_fn if delete_old else None
         self.save_ckpt_fn = os.path.join(
             self.logdir, 'last_checkpoint_ep{}.pth'.format(epoch))
-        torch.save(save_dict, self.save_ckpt_fn)
         self.save_metric = metric
 
         is_better = self.is_better(self.save_metric, self.best_metric,
                                    higher_better)
+        prev_best_fn = None
         if is_better:
-            if os.path.exists(self.best_ckpt_fn):
-                os.remove(self.best_ckpt_fn)
+            prev_best_fn = self.best_ckpt_fn
             self.best_ckpt_fn = os.path.join(
                 self.logdir, 'best_checkpoint_ep{}.pth'.format(epoch))
             self.best_metric = self.save_metric
-            copyfile(self.save_ckpt_fn, self.best_ckpt_fn)
+
+        write_args = (self.save_ckpt_fn, prev_save_fn, self.best_ckpt_fn,
+                      prev_best_fn, metric, epoch)
+        if self._save_pool is None:
+            self._write_checkpoint(save_dict, *write_args)
+        else:
+            self.wait_for_save()
+            self._save_future = self._save_pool.submit(
+                self._write_checkpoint, _snapshot(save_dict), *write_args)
         return is_better
 
+    def wait_for_save(self):
+        '''
+        Block until any in-flight asynchronous checkpoint write completes,
+        re-raising any error it hit.
+        '''
+        future = getattr(self, '_save_future', None)
+        if future is not None:
+            self._save_future = None
+            future.result()
+
+    def _write_checkpoint(self, save_dict, save_fn, prev_save_fn, best_fn,
+                          prev_best_fn, metric, epoch):
+        '''
+        Write out the latest checkpoint and, if `prev_best_fn` is not None,
+        make it the new best checkpoint.
+        '''
+        if prev_save_fn and os.path.exists(prev_save_fn):
+            os.remove(prev_save_fn)
+        # The best checkpoint may be a hardlink to an existing file of this
+        # name (e.g. when resuming), so unlink rather than write through it
+        if os.path.exists(save_fn):
+            os.remove(save_fn)
+        # Save out current model
+        torch.save(save_dict, save_fn)
+
+        if prev_best_fn is not None:
+            if os.path.exists(prev_best_fn):
+                os.remove(prev_best_fn)
+            if os.path.exists(best_fn):
+                os.remove(best_fn)
+            # Hardlink the best checkpoint to the latest one rather than
+            # copying it, falling back to a copy if the filesystem can't
+            try:
+                os.link(save_fn, best_fn)
+            except OSError:
+                copyfile(save_fn, best_fn)
+            self._write_best_metric(metric, epoch)
+
     def get_best_checkpoint(self):
         """
         Finds the checkpoint in `self.logdir` that is considered best.
@@ -328,17 +541,22 @@ class LogX(object):
             None - If there is no best checkpoint file
             path (str) - The full path to the best checkpoint otherwise.
         """
-        match_str = r'^best_checkpoint_ep([0-9]+).pth$'
         best_epoch = -1
         best_checkpoint = None
-        for filename in os.listdir(self.logdir):
-            match = re.fullmatch(match_str, filename)
-            if match is not None:
-                # Extract the epoch number
-                epoch = int(match.group(1))
-                if epoch > best_epoch:
-                    best_epoch = epoch
-                    best_checkpoint = filename
+        with os.scandir(self.logdir) as entries:
+            for entry in entries:
+                # Cheap prefix test first, since most files in the logdir
+                # (last checkpoints, tb events, metrics) aren't candidates
+                name = entry.name
+                if not name.startswith('best_checkpoint_ep'):
+                    continue
+                match = _BEST_CKPT_RE.fullmatch(name)
+                if match is not None and entry.is_file():
+                    # Extract the epoch number
+                    epoch = int(match.group(1))
+                    if epoch > best_epoch:
+                        best_epoch = epoch
+                        best_checkpoint = name
 
         if best_checkpoint is None:
             return None
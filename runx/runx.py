@@ -29,16 +29,22 @@ POSSIBILITY OF SUCH DAMAGE.
 """
 from __future__ import print_function
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from coolname import generate_slug
 from datetime import datetime
-from shutil import copytree, ignore_patterns
+from functools import lru_cache
+from shutil import copy2, copystat, copytree, rmtree
 
 import os
 import re
+import stat
+import fnmatch
 import sys
 import subprocess
 import argparse
 import itertools
+import tempfile
+import threading
 
 from .utils import read_config, exec_cmd, get_cfg
 from .farm import build_farm_cmd, upload_to_ngc
@@ -71,17 +77,18 @@ def expand_hparams(hparams):
     """
     Construct the training script args from the hparams
     """
-    cmd = ''
+    parts = []
+    append = parts.append
     for field, val in hparams.items():
-        if type(val) is bool:
+        if isinstance(val, bool):
             if val is True:
-                cmd += '--{} '.format(field)
+                append(f'--{field} ')
         elif val != 'None':
-            cmd += '--{} {} '.format(field, val)
-    return cmd
+            append(f'--{field} {val} ')
+    return ''.join(parts)
 
 
-def construct_cmd(cmd, hparams, logdir):
+def construct_cmd(cmd, hparams, logdir, pythonpath_tmpl, submit_cmd):
     """
     Build training command by starting with user-supplied 'CMD'
     and then adding in hyperparameters, which came from expanding the 
@@ -91,21 +98,22 @@ def construct_cmd(cmd, hparams, logdir):
 
     :cmd: farm submission command
     :hparams: hyperparams for training command
+    :pythonpath_tmpl: the PYTHONPATH config item, which may contain LOGDIR
+    :submit_cmd: the SUBMIT_CMD config item
     """
     # First, add hyperparameters
     cmd += ' ' + expand_hparams(hparams)
 
     # Expand PYTHONPATH, if necessary
-    if get_cfg('PYTHONPATH') is not None:
-        pythonpath = get_cfg('PYTHONPATH')
-        pythonpath = pythonpath.replace('LOGDIR', logdir)
+    if pythonpath_tmpl is not None:
+        pythonpath = pythonpath_tmpl.replace('LOGDIR', logdir)
     else:
         pythonpath = f'{logdir}/code'
 
     # For signalling reasons, we have to insert the exec here when using submit_job.
     # Nvidia-internal thing.
     exec_str = ''
-    if 'submit_job' in get_cfg('SUBMIT_CMD'):
+    if 'submit_job' in submit_cmd:
         exec_str = 'exec'
 
     cmd = f'cd {logdir}/code; PYTHONPATH={pythonpath} {exec_str} {cmd}'
@@ -116,14 +124,12 @@ def save_cmd(cmd, logdir):
     """
     Record the submit command
     """
-    fp = open(os.path.join(logdir, 'submit_cmd.sh'), 'w')
-    fp.write(cmd)
-    fp.write('\n')
-    fp.close()
+    with open(os.path.join(logdir, 'submit_cmd.sh'), 'w') as fp:
+        fp.write(cmd + '\n')
 
 
 def islist(elem):
-    return type(elem) is list or type(elem) is tuple
+    return isinstance(elem, (list, tuple))
 
 
 def cross_product_hparams(hparams):
@@ -139,10 +145,12 @@ def cross_product_hparams(hparams):
       the cross product for all combinations of all args.
 
     output:
-      The return value is a sequence of lists. Each list is one of the
-      permutations of argument values.
+      The return value is a lazy iterator over tuples, each tuple is one of
+      the permutations of argument values, along with the number of
+      permutations.
     """
     hparam_values = []
+    num_cases = 1
 
     # turn every hyperparam into a list, to prep for itertools.product
     for elem in hparams.values():
@@ -150,14 +158,10 @@ def cross_product_hparams(hparams):
             hparam_values.append(elem)
         else:
             hparam_values.append([elem])
+        num_cases *= len(hparam_values[-1])
 
     expanded_hparams = itertools.product(*hparam_values)
 
-    # have to do this in order to know length
-    expanded_hparams, dup_expanded = itertools.tee(expanded_hparams, 2)
-    expanded_hparams = list(expanded_hparams)
-    num_cases = len(list(dup_expanded))
-
     return expanded_hparams, num_cases
 
 
@@ -167,53 +171,211 @@ def get_field(adict, f, required=True):
     return adict[f] if f in adict else None
 
 
+@lru_cache(maxsize=None)
+def keyword_pattern(keywords):
+    """
+    Compile a regex that matches any of the keywords. Every run substitutes
+    the same keywords, only the replacements change, so this is cached.
+    """
+    return re.compile('|'.join(re.escape(k) for k in keywords))
+
+
 def do_keyword_expansion(alist, pairs):
     """
     Substitute a string in place of certain keywords
     """
-    if type(alist) is list or type(alist) is tuple:
+    if not pairs:
+        return
+    replacements = dict(pairs)
+    pattern = keyword_pattern(tuple(replacements))
+
+    def substitute(s):
+        return pattern.sub(lambda m: replacements[m.group(0)], s)
+
+    if islist(alist):
         for i, v in enumerate(alist):
-            if type(v) == str:
-                for k, v in pairs:
-                    alist[i] = alist[i].replace(k, v)
-    elif type(alist) is dict:
+            if isinstance(v, str):
+                alist[i] = substitute(v)
+    elif isinstance(alist, dict):
         for a_k, a_v in alist.items():
-            if type(a_v) == str:
-                for k, v in pairs:
-                    alist[a_k] = alist[a_k].replace(k, v)
+            if isinstance(a_v, str):
+                alist[a_k] = substitute(a_v)
     else:
         raise
 
 
-def make_cool_names():
-    tagname = args.tag + '_' if args.tag else ''
-    datestr = datetime.now().strftime("_%Y.%m.%d_%H.%M")
+def make_cool_names(tag, datestr):
+    """
+    :datestr: date suffix for the run name, shared by all runs of a sweep
+    """
+    tagname = tag + '_' if tag else ''
     if args.no_cooldir:
         coolname = tagname
     else:
         coolname = tagname + generate_slug(2) + datestr
 
     # Experiment directory is the parent of N runs
-    expdir = os.path.join(get_cfg('LOGROOT'), get_cfg('EXP_NAME'))
+    exp_name = get_cfg('EXP_NAME')
+    expdir = os.path.join(get_cfg('LOGROOT'), exp_name)
 
     # Each run has a logdir
     logdir_name = coolname
     logdir = os.path.join(expdir, logdir_name)
 
     # Jobname is a unique name for the batch job
-    job_name = '{}_{}'.format(get_cfg('EXP_NAME'), coolname)
+    job_name = '{}_{}'.format(exp_name, coolname)
     return job_name, logdir, logdir_name, expdir
 
 
-def copy_code(logdir, runroot, code_ignore_patterns):
+# A private, read-only copy of the code for each experiment directory, along
+# with its tree_fingerprint. No job ever runs in it. Submitted runs of the
+# same experiment are hardlinked against it, instead of copying the whole
+# codebase again.
+_code_snapshots = {}
+_code_snapshots_lock = threading.Lock()
+
+
+def copy_file(src, dst, follow_symlinks=True):
+    """
+    copytree copy_function: like shutil.copy2, but uses copy_file_range where
+    available, so file data stays in the kernel and NFS servers that support
+    it can do the copy server-side.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return copy2(src, dst, follow_symlinks=follow_symlinks)
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            infd, outfd = fsrc.fileno(), fdst.fileno()
+            while os.copy_file_range(infd, outfd, 1 << 30):
+                pass
+    except OSError:
+        # e.g. unsupported by this kernel or filesystem
+        return copy2(src, dst, follow_symlinks=follow_symlinks)
+    copystat(src, dst, follow_symlinks=follow_symlinks)
+    return dst
+
+
+def tree_fingerprint(root, code_ignore_fn):
+    """
+    Summarize the files that copytree would copy out of root by their path
+    relative to root, size and mtime. This only needs a stat per file, so
+    it's much cheaper than copying the tree.
+    """
+    fingerprint = []
+    for dirpath, dirs, files in os.walk(root, followlinks=True):
+        ignored = code_ignore_fn(dirpath, dirs + files)
+        dirs[:] = sorted(d for d in dirs if d not in ignored)
+        for name in sorted(files):
+            if name in ignored:
+                continue
+            fn = os.path.join(dirpath, name)
+            st = os.stat(fn)
+            fingerprint.append((os.path.relpath(fn, root), st.st_size,
+                                st.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+def make_read_only(root):
+    """
+    Clear the write bits of all files under root
+    """
+    for dirpath, dirs, files in os.walk(root):
+        for name in files:
+            fn = os.path.join(dirpath, name)
+            mode = stat.S_IMODE(os.lstat(fn).st_mode)
+            os.chmod(fn, mode & ~0o222)
+
+
+def get_code_snapshot(expdir, runroot, code_ignore_fn):
+    """
+    Return the (snapshot_dir, fingerprint) of expdir's code snapshot, making
+    it first if needed. The snapshot's files are read-only, so that the runs
+    which are linked against it can't modify each other's code.
+    """
+    with _code_snapshots_lock:
+        snapshot = _code_snapshots.get(expdir)
+        if snapshot is None:
+            os.makedirs(expdir, exist_ok=True)
+            snapshot_dir = os.path.join(
+                tempfile.mkdtemp(prefix='.runx_code_', dir=expdir), 'code')
+            copytree(runroot, snapshot_dir, ignore=code_ignore_fn,
+                     copy_function=copy_file)
+            make_read_only(snapshot_dir)
+            # copy_file preserves mtimes, so this also tells whether the code
+            # changed while the snapshot was being made
+            fingerprint = tree_fingerprint(snapshot_dir, code_ignore_fn)
+            snapshot = (snapshot_dir, fingerprint)
+            _code_snapshots[expdir] = snapshot
+    return snapshot
+
+
+def remove_code_snapshots():
+    """
+    Delete the code snapshots once all runs have been staged. The runs' own
+    links to the files stay intact.
+    """
+    with _code_snapshots_lock:
+        for snapshot_dir, _ in _code_snapshots.values():
+            rmtree(os.path.dirname(snapshot_dir), ignore_errors=True)
+        _code_snapshots.clear()
+
+
+def link_tree(src_code_dir, tgt_code_dir):
+    """
+    Recreate src_code_dir at tgt_code_dir out of hardlinks. Returns False if
+    the filesystem doesn't support that.
+    """
+    try:
+        copytree(src_code_dir, tgt_code_dir, copy_function=os.link)
+    except OSError:
+        rmtree(tgt_code_dir, ignore_errors=True)
+        return False
+    return True
+
+
+def rsync_code(runroot, tgt_code_dir, link_dest, code_ignore_patterns):
+    """
+    Copy runroot to tgt_code_dir with rsync, hardlinking any files that are
+    unchanged in link_dest. Returns False if rsync isn't available or fails.
+    """
+    cmd = ['rsync', '-rtL', f'--link-dest={link_dest}']
+    cmd += [f'--exclude={p}' for p in code_ignore_patterns]
+    cmd += [f'{runroot}/', f'{tgt_code_dir}/']
+    try:
+        return subprocess.call(cmd) == 0
+    except OSError:
+        return False
+
+
+def copy_code(logdir, expdir, runroot, code_ignore_patterns, code_ignore_fn,
+              link=True):
     """
     Copy sourcecode to logdir's code directory
+
+    :code_ignore_patterns: list of glob patterns to not copy
+    :code_ignore_fn: copytree ignore callable, from compile_ignore_patterns
+    :link: hardlink unchanged files against the experiment's read-only code
+           snapshot instead of copying them
     """
     print('Copying codebase to {} ...'.format(logdir))
     tgt_code_dir = os.path.join(logdir, 'code')
-    if code_ignore_patterns is not None:
-        code_ignore_patterns = ignore_patterns(*code_ignore_patterns)
-    copytree(runroot, tgt_code_dir, ignore=code_ignore_patterns)
+
+    if link:
+        snapshot_dir, snapshot_fingerprint = get_code_snapshot(
+            expdir, runroot, code_ignore_fn)
+
+        # If the code hasn't changed since the snapshot, just link to it.
+        # Otherwise have rsync work out which files can still be linked.
+        if tree_fingerprint(runroot, code_ignore_fn) == snapshot_fingerprint \
+           and link_tree(snapshot_dir, tgt_code_dir):
+            return
+        if rsync_code(runroot, tgt_code_dir, snapshot_dir,
+                      code_ignore_patterns):
+            return
+        rmtree(tgt_code_dir, ignore_errors=True)
+
+    copytree(runroot, tgt_code_dir, ignore=code_ignore_fn,
+             copy_function=copy_file)
 
 
 def hacky_substitutions(hparams, resource_copy, logdir, runroot):
@@ -243,22 +405,23 @@ def hacky_substitutions(hparams, resource_copy, logdir, runroot):
 
 
 def get_tag(hparams):
-    # Pull tag from hparams and then remove it
-    # Also can do variable substitution into tag
-    if 'RUNX.TAG' in hparams:
-        tag_val = hparams['RUNX.TAG']
+    """
+    Pull tag from hparams and then remove it
+    Also can do variable substitution into tag
 
-        # do variable expansion:
-        for sub_key, sub_val in hparams.items():
-            search_str = '{' + sub_key + '}'
-            tag_val = re.sub(search_str, str(sub_val), tag_val)
-        hparams['RUNX.TAG'] = tag_val
-        args.tag = tag_val
-        del hparams['RUNX.TAG']
+    Returns the expanded tag, or None if hparams has no RUNX.TAG
+    """
+    if 'RUNX.TAG' not in hparams:
+        return None
 
+    tag_val = hparams.pop('RUNX.TAG')
 
-def skip_run(hparams):
-    return 'RUNX.SKIP' in hparams and hparams['RUNX.SKIP']
+    # do variable expansion, replacing every {hparam} in a single pass:
+    if '{' in tag_val and hparams:
+        replacements = {'{' + k + '}': str(v) for k, v in hparams.items()}
+        pattern = keyword_pattern(tuple(replacements))
+        tag_val = pattern.sub(lambda m: replacements[m.group(0)], tag_val)
+    return tag_val
 
 
 def get_code_ignore_patterns(experiment):
@@ -267,20 +430,108 @@ def get_code_ignore_patterns(experiment):
     else:
         code_ignore_patterns = '.git,*.pyc,docs*,test*'
 
-    code_ignore_patterns += ',*.pth' # don't copy checkpoints
-    code_ignore_patterns = code_ignore_patterns.split(',')
+    code_ignore_patterns = [p.strip() for p in code_ignore_patterns.split(',')]
+    code_ignore_patterns.append('*.pth')  # don't copy checkpoints
     return code_ignore_patterns
 
 
-def run_yaml(experiment, runroot):
+def compile_ignore_patterns(code_ignore_patterns):
+    """
+    Build a copytree ignore callable out of a list of glob patterns.
+
+    This is equivalent to shutil.ignore_patterns, except that all of the
+    patterns are translated into a single precompiled regex up front instead
+    of being matched one by one for every directory that gets copied.
+    """
+    ignore_re = re.compile('|'.join(fnmatch.translate(p)
+                                    for p in code_ignore_patterns))
+    match = ignore_re.match
+
+    def ignore_fn(path, names):
+        return {name for name in names if match(name)}
+    return ignore_fn
+
+
+def add_permissions(path, bits):
+    """
+    Same as `chmod a+rw` for bits=0o666. Errors are ignored, like with the
+    chmod command.
+    """
+    try:
+        mode = stat.S_IMODE(os.lstat(path).st_mode)
+        if mode & bits != bits:
+            os.chmod(path, mode | bits)
+    except OSError:
+        pass
+
+
+def make_run_writable(logdir, expdir):
+    """
+    Let everyone read and write the new run directory, which every user of a
+    shared LOGROOT relies on. Only the experiment directory itself and this
+    run's files need to be visited, not the runs that came before.
+
+    Files that are hardlinked from the experiment's code snapshot are shared
+    with other runs, so those are only made readable.
+    """
+    add_permissions(expdir, 0o666)
+    for root, dirs, files in os.walk(logdir):
+        add_permissions(root, 0o666)
+        for name in files:
+            fn = os.path.join(root, name)
+            try:
+                st = os.lstat(fn)
+            except OSError:
+                continue
+            if stat.S_ISLNK(st.st_mode):
+                continue
+            add_permissions(fn, 0o444 if st.st_nlink > 1 else 0o666)
+
+
+def dispatch_run(job_name, cmd, logdir, expdir, runroot, code_ignore_patterns,
+                 code_ignore_fn, ngc_batch):
+    """
+    Stage the code for a single run and then launch it
+    """
+    # copy code to NFS-mounted share. Interactive runs execute right away in
+    # their own copy, so only submitted runs are linked against the snapshot,
+    # and only if LINK_CODE asks for it.
+    copy_code(logdir, expdir, runroot, code_ignore_patterns, code_ignore_fn,
+              link=get_cfg('LINK_CODE') and not args.interactive)
+
+    # save some meta-data from run
+    save_cmd(cmd, logdir)
+
+    # upload to remote farm
+    if ngc_batch:
+        upload_to_ngc(logdir)
+
+    make_run_writable(logdir, expdir)
+
+    if args.interactive:
+        print('Running job {}'.format(job_name))
+    else:
+        print('Submitting job {}'.format(job_name))
+    exec_cmd(cmd, cwd=logdir)
+
+
+def run_yaml(experiment, runroot, datestr):
     """
     Run an experiment, expand hparams
     """
     resources = get_field(experiment, 'RESOURCES')
     code_ignore_patterns = get_code_ignore_patterns(experiment)
+    code_ignore_fn = compile_ignore_patterns(code_ignore_patterns)
     ngc_batch = 'ngc' in get_cfg('FARM') and not args.interactive
     experiment_cmd = experiment['CMD']
 
+    # These config items are the same for every run
+    pythonpath_tmpl = get_cfg('PYTHONPATH')
+    submit_cmd = get_cfg('SUBMIT_CMD')
+    if ngc_batch:
+        logroot = get_cfg('LOGROOT')
+        ngc_logroot = get_cfg('NGC_LOGROOT')
+
     # Build the args that the submit_cmd will see
     yaml_hparams = OrderedDict()
 
@@ -291,18 +542,27 @@ def run_yaml(experiment, runroot):
     # Calculate cross-product of hyperparams
     expanded_hparams, num_cases = cross_product_hparams(yaml_hparams)
 
+    hparam_keys = tuple(yaml_hparams.keys())
+    # Position of RUNX.SKIP, so that skipped permutations can be dropped
+    # before building anything for them
+    skip_idx = hparam_keys.index('RUNX.SKIP') \
+        if 'RUNX.SKIP' in yaml_hparams else None
+
+    # Runs to be launched, as (job_name, cmd, logdir, expdir)
+    runs = []
+
     # Run each permutation
     for i, hparam_vals in enumerate(expanded_hparams):
-        hparam_vals = list(hparam_vals)
-        hparam_keys = list(yaml_hparams.keys())
+        if skip_idx is not None and hparam_vals[skip_idx]:
+            continue
 
         # hparams to use for experiment
-        hparams = {k: v for k, v in zip(hparam_keys, hparam_vals)}
-        if skip_run(hparams):
-            continue
-        get_tag(hparams)
+        hparams = dict(zip(hparam_keys, hparam_vals))
+        tag = get_tag(hparams)
+        if tag is None:
+            tag = args.tag
 
-        job_name, logdir, coolname, expdir = make_cool_names()
+        job_name, logdir, coolname, expdir = make_cool_names(tag, datestr)
         resource_copy = resources.copy()
 
         """
@@ -324,15 +584,16 @@ def run_yaml(experiment, runroot):
            c. call cmd, which should invoke SUBMIT_JOB==`ngc batch run`
         """
         if ngc_batch:
-            ngc_logdir = logdir.replace(get_cfg('LOGROOT'),
-                                        get_cfg('NGC_LOGROOT'))
+            ngc_logdir = logdir.replace(logroot, ngc_logroot)
             hacky_substitutions(
                 hparams, resource_copy, ngc_logdir, runroot)
-            cmd = construct_cmd(experiment_cmd, hparams, ngc_logdir)
+            cmd = construct_cmd(experiment_cmd, hparams, ngc_logdir,
+                                pythonpath_tmpl, submit_cmd)
         else:
             hacky_substitutions(
                 hparams, resource_copy, logdir, runroot)
-            cmd = construct_cmd(experiment_cmd, hparams, logdir)
+            cmd = construct_cmd(experiment_cmd, hparams, logdir,
+                                pythonpath_tmpl, submit_cmd)
 
         if not args.interactive:
             cmd = build_farm_cmd(cmd, job_name, resource_copy, logdir)
@@ -341,24 +602,41 @@ def run_yaml(experiment, runroot):
             print(cmd)
             continue
 
-        # copy code to NFS-mounted share
-        copy_code(logdir, runroot, code_ignore_patterns)
-
-        # save some meta-data from run
-        save_cmd(cmd, logdir)
-
-        # upload to remote farm
-        if ngc_batch:
-            upload_to_ngc(logdir)
-
-        subprocess.call(['chmod', '-R', 'a+rw', expdir])
-        os.chdir(logdir)
-
-        if args.interactive:
-            print('Running job {}'.format(job_name))
-        else:
-            print('Submitting job {}'.format(job_name))
-        exec_cmd(cmd)
+        runs.append((job_name, cmd, logdir, expdir))
+
+    try:
+        dispatch_runs(runs, runroot, code_ignore_patterns, code_ignore_fn,
+                      ngc_batch)
+    finally:
+        remove_code_snapshots()
+
+
+def dispatch_runs(runs, runroot, code_ignore_patterns, code_ignore_fn,
+                  ngc_batch):
+    # Interactive runs execute one after the other. Farm submissions don't
+    # depend on each other though, so stage and submit those in parallel.
+    if args.interactive or len(runs) < 2:
+        for run in runs:
+            dispatch_run(*run, runroot, code_ignore_patterns, code_ignore_fn,
+                         ngc_batch)
+        return
+
+    num_workers = min(get_cfg('DISPATCH_WORKERS'), len(runs))
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(dispatch_run, *run, runroot,
+                               code_ignore_patterns, code_ignore_fn,
+                               ngc_batch)
+                   for run in runs]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # Stop at the first failure or Ctrl-C, like the sequential loop
+            # did, rather than letting shutdown stage and submit every run
+            # that's still queued
+            for future in futures:
+                future.cancel()
+            raise
 
 
 def run_experiment(exp_fn):
@@ -372,6 +650,8 @@ def run_experiment(exp_fn):
 
     # Iterate over hparams if it's a list
     runroot = os.getcwd()
+    # All of the runs get the same timestamp, so that they sort together
+    datestr = datetime.now().strftime("_%Y.%m.%d_%H.%M")
     if isinstance(experiment['HPARAMS'], (list, tuple)):
         # Support inheritance from the first hparams item in list
         first_hparams = experiment['HPARAMS'][0].copy()
@@ -385,9 +665,9 @@ def run_experiment(exp_fn):
             experiment_copy = experiment.copy()
             experiment_copy['HPARAMS'] = hparams
 
-            run_yaml(experiment_copy, runroot)
+            run_yaml(experiment_copy, runroot, datestr)
     else:
-        run_yaml(experiment, runroot)
+        run_yaml(experiment, runroot, datestr)
 
 
 def main():
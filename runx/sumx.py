@@ -28,10 +28,11 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
 from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
 from tabulate import tabulate
 
 import os
-import copy
+import sys
 import argparse
 import time
 import json
@@ -39,6 +40,11 @@ import csv
 
 from .utils import read_config, get_cfg
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 parser = argparse.ArgumentParser(
     description='Summarize run results',
@@ -65,12 +71,23 @@ else:
     args.ignore = []
 args.ignore += ['logdir', 'command', 'result_dir', 'nbr_workers', 'paths',
                 'val_paths']
+args.ignore = frozenset(args.ignore)
+
+# Maximum number of runs whose files are read at the same time
+_READ_WORKERS = 32
 
 
 def load_json(fname):
-    with open(fname) as json_data:
-        adict = json.load(json_data)
-    return adict
+    with open(fname, 'rb') as json_data:
+        data = json_data.read()
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # orjson is stricter than json, which also accepts things like
+            # NaN, which json.dump writes out for float('nan') hparams
+            pass
+    return json.loads(data)
 
 
 def get_runs(parent_dir):
@@ -80,26 +97,46 @@ def get_runs(parent_dir):
     Look for code.tgz file.
     '''
     runs = []
-    for adir in os.listdir(parent_dir):
-        run_dir = os.path.join(parent_dir, adir)
-        hparams_fn = os.path.join(run_dir, 'hparams.json')
-        if os.path.isfile(hparams_fn):
-            runs += [run_dir]
+    with os.scandir(parent_dir) as it:
+        for entry in it:
+            # is_dir() normally comes for free from the directory listing,
+            # so only directories cost a stat for their hparams.json
+            if not entry.is_dir():
+                continue
+            hparams_fn = os.path.join(entry.path, 'hparams.json')
+            if os.path.isfile(hparams_fn):
+                runs.append(entry.path)
 
     return runs
 
 
+def read_runs(fn, runs):
+    '''
+    Call fn on each run, reading the runs' files in parallel since this is
+    dominated by filesystem latency. Results are returned in run order.
+    '''
+    if len(runs) < 2:
+        return [fn(run) for run in runs]
+    with ThreadPoolExecutor(max_workers=min(_READ_WORKERS, len(runs))) as ex:
+        return list(ex.map(fn, runs))
+
+
+def read_hparams(run):
+    json_fn = os.path.join(run, 'hparams.json')
+    assert os.path.isfile(json_fn), \
+        'hparams.json not found in {}'.format(run)
+    # The same names, and often the same values, repeat across every run of
+    # an experiment. Interning them shares one copy of each string, and makes
+    # the comparisons in get_uncommon_hparam_names identity checks.
+    return {sys.intern(k): sys.intern(v) if isinstance(v, str) else v
+            for k, v in load_json(json_fn).items()}
+
+
 def get_hparams(runs):
     '''
     given a list of full paths to directories, read in all hparams
     '''
-    hparams = {}
-    for run in runs:
-        json_fn = os.path.join(run, 'hparams.json')
-        assert os.path.isfile(json_fn), \
-            'hparams.json not found in {}'.format(run)
-        hparams[run] = load_json(json_fn)
-    return hparams
+    return dict(zip(runs, read_runs(read_hparams, runs)))
 
 
 def load_csv(csv_fn):
@@ -133,63 +170,20 @@ def avg_time_util(metrics_fn):
             return metric_dict
 
 
-def extract_nontime_metrics(m):
-    """
-    Read latest metrics out of metrics file.
-
-    if args.sortwith is defined, also capture the best value for the
-    args.sortwith metric and add that into the dict returned
-    """
-    metrics = copy.deepcopy(m)
-    metrics.reverse()
-
-    skip_metrics = ('timestamp', 'gpu util')
-
-    epochs = 0
-    metric_dict = {}
-    saw_final_metrics = False
-    best_sortwith = None
-
-    for metric_line in metrics:
-        phase = metric_line[0]
-        metric_line = metric_line[1:]
-        if phase == 'val':
-            keys = metric_line[0::2]  # evens
-            vals = metric_line[1::2]  # odds
-            this_line_metrics = dict(zip(keys, vals))
-
-            # Capture the final validation metrics
-            if not saw_final_metrics:
-                saw_final_metrics = True
-                for k, v in this_line_metrics.items():
-                    if k not in skip_metrics:
-                        metric_dict[k] = v
-                    # make the assumption that validation step == epoch
-                    if k == 'step' or k == 'epoch':
-                        epochs = int(v)
-
-            # Update the best value for sortwith
-            if args.sortwith:
-                assert args.sortwith in this_line_metrics
-
-                if best_sortwith is None or \
-                   best_sortwith < this_line_metrics[args.sortwith]:
-                    best_sortwith = this_line_metrics[args.sortwith]
-                    metric_dict[args.sortwith + '-best'] = best_sortwith
-
-    return metric_dict, epochs
-
-
-def get_epoch_time(metrics, epochs):
-    first_time = 0
-    last_time = 0
+def numeric_key(val):
+    '''
+    Sort key for a metric value. Metrics are read back from the csv as
+    strings, so compare them as numbers where possible, otherwise '9.5' would
+    sort above '10.2'. Values that aren't numbers, like the '' written for a
+    None metric, rank below all numbers and are compared as strings.
+    '''
+    try:
+        return (1, float(val))
+    except (TypeError, ValueError):
+        return (0, str(val))
 
-    # first line should always contain the beginning timestamp
-    start_metric = metrics[0]
-    val_metrics = [m for m in metrics if 'val' in m]
-    # last val line should be time at last epoch
-    last_metric = val_metrics[-1]
 
+def get_epoch_time(start_metric, last_metric, epochs):
     assert 'start' in start_metric, \
         'expected start timestamp in first line of metrics file'
     if 'timestamp' not in start_metric or 'timestamp' not in last_metric:
@@ -207,11 +201,6 @@ def get_epoch_time(metrics, epochs):
     return epoch_time
 
 
-def has_val(metrics):
-    counts = [v[0] == 'val' for v in metrics]
-    return sum(counts)
-
-
 def get_final_metrics(metrics_fn):
     '''
     read in a metrics file
@@ -219,17 +208,81 @@ def get_final_metrics(metrics_fn):
     return a dict of the final metrics for test/val
     also include epoch #
     and average minutes/epoch
+
+    if args.sortwith is defined, also capture the best value for the
+    args.sortwith metric and add that into the dict returned
+
+    The file is streamed in a single pass, only keeping the lines that are
+    needed: the first one, which has the start timestamp, and the latest
+    validation line.
     '''
+    start_metric = None
+    last_val_line = None
+    final_val_line = None
+    best_sortwith = None
+    best_sortwith_key = None
+    sortwith_idx = None
+
+    with open(metrics_fn) as fp:
+        csv_reader = csv.reader((x.replace('\0', '') for x in fp),
+                                delimiter=',')
+        for metric_line in csv_reader:
+            if start_metric is None:
+                start_metric = metric_line
+            if 'val' in metric_line:
+                last_val_line = metric_line
+            if not metric_line or metric_line[0] != 'val':
+                continue
+
+            final_val_line = metric_line
+
+            # Update the best value for sortwith. The metric is normally in
+            # the same column on every line, so only search for it when it
+            # isn't.
+            if args.sortwith:
+                if sortwith_idx is None or \
+                   metric_line[sortwith_idx:sortwith_idx + 1] != \
+                   [args.sortwith]:
+                    keys = metric_line[1::2]
+                    assert args.sortwith in keys
+                    sortwith_idx = 2 * keys.index(args.sortwith) + 1
+                this_sortwith = metric_line[sortwith_idx + 1]
+
+                this_sortwith_key = numeric_key(this_sortwith)
+                if best_sortwith is None or \
+                   best_sortwith_key < this_sortwith_key:
+                    best_sortwith = this_sortwith
+                    best_sortwith_key = this_sortwith_key
 
-    # Extract reported metrics
-    metrics = load_csv(metrics_fn)
-    if has_val(metrics):
-        metric_dict, epochs = extract_nontime_metrics(metrics)
-        metric_dict.update({'epoch time': get_epoch_time(metrics, epochs)})
-        return metric_dict
-    else:
+    if final_val_line is None:
         return None
 
+    # Capture the final validation metrics
+    keys = final_val_line[1::2]  # evens
+    vals = final_val_line[2::2]  # odds
+    skip_metrics = ('timestamp', 'gpu util')
+    epochs = 0
+    metric_dict = {}
+    for k, v in zip(keys, vals):
+        if k not in skip_metrics:
+            metric_dict[k] = v
+        # make the assumption that validation step == epoch
+        if k == 'step' or k == 'epoch':
+            epochs = int(v)
+    if args.sortwith:
+        metric_dict[args.sortwith + '-best'] = best_sortwith
+
+    metric_dict.update({'epoch time': get_epoch_time(start_metric,
+                                                     last_val_line, epochs)})
+    return metric_dict
+
+
+def read_metrics(run):
+    metrics_fn = os.path.join(run, 'metrics.csv')
+    if not os.path.isfile(metrics_fn):
+        return None
+    return get_final_metrics(metrics_fn)
+
 
 def get_metrics(runs):
     '''
@@ -239,11 +292,7 @@ def get_metrics(runs):
     output: metrics dict and metrics names
     '''
     metrics = {}
-    for run in runs:
-        metrics_fn = os.path.join(run, 'metrics.csv')
-        if not os.path.isfile(metrics_fn):
-            continue
-        metrics_run = get_final_metrics(metrics_fn)
+    for run, metrics_run in zip(runs, read_runs(read_metrics, runs)):
         if metrics_run is not None:
             metrics[run] = metrics_run
 
@@ -272,22 +321,22 @@ def get_uncommon_hparam_names(all_runs):
     if len(all_runs) <= 1:
         return []
 
-    # assemble all keys
-    all_hparams = {}
-    for run in all_runs.values():
-        for p in run.keys():
-            all_hparams[p] = 1
+    # assemble all keys, in the order they're first seen
+    runs = list(all_runs.values())
+    all_hparams = dict.fromkeys(p for run in runs for p in run)
 
     # find all items that ever have different values
     uncommon_list = []
     for k in all_hparams:
-        all_values = []
-        for hparams in all_runs.values():
-            if k in hparams:
-                all_values.append(hparams[k])
-            else:
-                all_values.append(None)
-        if any_different(all_values) and k not in args.ignore:
+        if k in args.ignore:
+            continue
+        all_values = [hparams.get(k) for hparams in runs]
+        try:
+            different = len(set(all_values)) > 1
+        except TypeError:
+            # unhashable values, such as lists
+            different = any_different(all_values)
+        if different:
             uncommon_list.append(k)
 
     return uncommon_list
@@ -362,7 +411,7 @@ def summarize_experiment(parent_dir):
 
     if do_sort:
         def get_key(entry):
-            return entry[idx]
+            return numeric_key(entry[idx])
 
         try:
             tablebody = sorted(tablebody, key=get_key, reverse=True)
@@ -372,11 +421,8 @@ def summarize_experiment(parent_dir):
 
     if args.csv is not None:
         unf_table = [header] + tablebody
-        f = open("{}.csv".format(args.csv), "w+")
-        for row in unf_table:
-            for column in row:
-                f.write("{}, ".format(column))
-            f.write("\n")
+        with open("{}.csv".format(args.csv), "w", newline='') as f:
+            csv.writer(f).writerows(unf_table)
 
     # We chop long strings into multiple lines if they contain '.' or '_'
     # This helps keep the output table more compact
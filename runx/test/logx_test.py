@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 import tempfile
@@ -157,6 +158,24 @@ class LogXTest(unittest.TestCase):
         else:
             self.assertFalse(os.path.exists(metrics_file))
 
+    def test_csv_batch_exception(self):
+        self.log_x.initialize(self.test_dir, tensorboard=False)
+
+        with self.assertRaises(RuntimeError):
+            with self.log_x.csv_batch():
+                for i in range(3):
+                    self.log_x.metric('val', {'top1': i * 0.1}, epoch=i)
+                raise RuntimeError('oops')
+
+        # The rows from the block get flushed on the way out, and later rows
+        # aren't held back anymore
+        self.log_x.metric('val', {'top1': 0.3}, epoch=3)
+
+        metrics_file = os.path.join(self.test_dir, 'metrics.csv')
+        with open(metrics_file, 'r') as fd:
+            lines = [line for line in fd.read().splitlines()[1:] if line]
+        self.assertEqual(len(lines), 4)
+
     def test_best_checkpoint(self):
         self.log_x.initialize(self.test_dir)
 
@@ -272,6 +291,92 @@ class LogXTest(unittest.TestCase):
         if rank == 0:
             dict_test(model2, torch.load(self.log_x.get_best_checkpoint()))
 
+    def test_async_save(self):
+        self.log_x.initialize(self.test_dir, async_save=True)
+
+        model1 = {
+            'val1': 42,
+            'val3': torch.tensor([[1, 2], [3, 4]], dtype=torch.float32)
+        }
+        self.log_x.save_model(model1, metric=0.5, epoch=0)
+        # Training keeps updating the tensors while the checkpoint is written,
+        # that mustn't leak into the checkpoint
+        model1['val3'].mul_(0)
+        self.log_x.wait_for_save()
+
+        best = torch.load(self.log_x.get_best_checkpoint())
+        self.assertTrue(torch.allclose(
+            best['val3'],
+            torch.tensor([[1, 2], [3, 4]], dtype=torch.float32)))
+        self.assertEqual(best['val1'], 42)
+
+        model2 = {'val1': 47}
+        self.log_x.save_model(model2, metric=0.7, epoch=50)
+
+        # Once the in-flight write is done, resuming picks up its best metric
+        self.log_x.wait_for_save()
+        del self.log_x
+        self.log_x = logx.LogX()
+        self.log_x.initialize(self.test_dir, async_save=True)
+        self.assertEqual(self.log_x.best_metric, 0.7)
+
+        self.log_x.save_model({'val1': 2}, metric=0.6, epoch=60)
+        self.log_x.wait_for_save()
+        self.assertEqual(
+            self.log_x.get_best_checkpoint(),
+            os.path.join(self.test_dir, 'best_checkpoint_ep50.pth'))
+        self.assertEqual(
+            torch.load(self.log_x.get_best_checkpoint())['val1'], 47)
+
+    @parameterized.expand([
+        ['mismatched', '{"metric": 0.1, "epoch": 3}'],
+        ['corrupt', '{"metric": 0.'],
+        ['missing', None],
+    ])
+    def test_best_metric_sidecar(self, _, sidecar):
+        self.log_x.initialize(self.test_dir)
+        self.log_x.save_model({'val1': 47}, metric=0.7, epoch=50)
+
+        sidecar_fn = os.path.join(self.test_dir, logx._BEST_METRIC_FN)
+        with open(sidecar_fn) as fd:
+            self.assertEqual(json.load(fd), {'metric': 0.7, 'epoch': 50})
+
+        if sidecar is None:
+            os.remove(sidecar_fn)
+        else:
+            with open(sidecar_fn, 'w') as fd:
+                fd.write(sidecar)
+
+        # A sidecar that doesn't describe the best checkpoint is ignored, and
+        # the metric is read from the checkpoint itself
+        del self.log_x
+        self.log_x = logx.LogX()
+        self.log_x.initialize(self.test_dir)
+        self.assertEqual(self.log_x.best_metric, 0.7)
+
+        self.assertFalse(
+            self.log_x.save_model({'val1': 2}, metric=0.6, epoch=60))
+        self.assertEqual(
+            torch.load(self.log_x.get_best_checkpoint())['val1'], 47)
+
+    def test_best_checkpoint_hardlink(self):
+        self.log_x.initialize(self.test_dir)
+        self.log_x.save_model({'val1': 42}, metric=0.5, epoch=0)
+
+        best_fn = os.path.join(self.test_dir, 'best_checkpoint_ep0.pth')
+        last_fn = os.path.join(self.test_dir, 'last_checkpoint_ep0.pth')
+        self.assertTrue(os.path.samefile(best_fn, last_fn))
+
+        # A worse checkpoint replaces the last one, the best one must survive
+        self.log_x.save_model({'val1': 2}, metric=0.4, epoch=1)
+
+        self.assertFalse(os.path.exists(last_fn))
+        self.assertEqual(os.stat(best_fn).st_nlink, 1)
+        self.assertEqual(torch.load(best_fn)['val1'], 42)
+        self.assertEqual(
+            torch.load(os.path.join(self.test_dir,
+                                    'last_checkpoint_ep1.pth'))['val1'], 2)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,124 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# runx.py uses package-relative imports and parses the command line when it's
+# imported, so import it as part of the package with a dummy experiment yaml
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+_argv = sys.argv
+sys.argv = ['runx', 'exp.yml']
+try:
+    from runx import runx
+finally:
+    sys.argv = _argv
+
+
+def read(fn):
+    with open(fn) as fp:
+        return fp.read()
+
+
+def write(fn, text, mode='w'):
+    with open(fn, mode) as fp:
+        fp.write(text)
+
+
+class CopyCodeTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.runroot = os.path.join(self.test_dir, 'src')
+        os.makedirs(os.path.join(self.runroot, 'pkg'))
+        write(os.path.join(self.runroot, 'train.py'), 'print(1)\n')
+        write(os.path.join(self.runroot, 'pkg', 'model.py'), 'pass\n')
+        write(os.path.join(self.runroot, 'train.pyc'), 'compiled')
+        self.patterns = runx.get_code_ignore_patterns({})
+        self.ignore_fn = runx.compile_ignore_patterns(self.patterns)
+        self.expdir = os.path.join(self.test_dir, 'logs', 'exp')
+
+    def tearDown(self):
+        runx.remove_code_snapshots()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def stage(self, name, link=True):
+        logdir = os.path.join(self.expdir, name)
+        runx.copy_code(logdir, self.expdir, self.runroot, self.patterns,
+                       self.ignore_fn, link=link)
+        runx.make_run_writable(logdir, self.expdir)
+        return os.path.join(logdir, 'code')
+
+    def test_linked_runs_are_isolated(self):
+        code1 = self.stage('run1')
+        # the first job writes into its code directory before the second run
+        # is staged
+        write(os.path.join(code1, 'outputs.txt'), 'run1\n')
+        code2 = self.stage('run2')
+
+        self.assertFalse(os.path.exists(os.path.join(code2, 'outputs.txt')))
+        self.assertFalse(os.path.exists(os.path.join(code2, 'train.pyc')))
+        self.assertEqual(read(os.path.join(code2, 'pkg', 'model.py')),
+                         'pass\n')
+
+        # unchanged files are shared, but nobody can write to them
+        for code in (code1, code2):
+            st = os.stat(os.path.join(code, 'train.py'))
+            self.assertEqual(st.st_nlink, 3)
+            self.assertEqual(stat.S_IMODE(st.st_mode) & 0o222, 0)
+            self.assertEqual(stat.S_IMODE(st.st_mode) & 0o444, 0o444)
+
+        # only the runs are left behind once the snapshot is removed
+        runx.remove_code_snapshots()
+        self.assertEqual(sorted(os.listdir(self.expdir)), ['run1', 'run2'])
+        self.assertEqual(os.stat(os.path.join(code2, 'train.py')).st_nlink, 2)
+
+    def test_changed_code_is_copied(self):
+        code1 = self.stage('run1')
+        write(os.path.join(self.runroot, 'train.py'), 'print(2)\n')
+        code2 = self.stage('run2')
+
+        self.assertEqual(read(os.path.join(code1, 'train.py')), 'print(1)\n')
+        self.assertEqual(read(os.path.join(code2, 'train.py')), 'print(2)\n')
+        self.assertFalse(os.path.samefile(os.path.join(code1, 'train.py'),
+                                          os.path.join(code2, 'train.py')))
+
+    def test_interactive_runs_are_copied(self):
+        code1 = self.stage('run1', link=False)
+        code2 = self.stage('run2', link=False)
+
+        for code in (code1, code2):
+            st = os.stat(os.path.join(code, 'train.py'))
+            self.assertEqual(st.st_nlink, 1)
+            self.assertEqual(stat.S_IMODE(st.st_mode) & 0o666, 0o666)
+        self.assertFalse(os.path.exists(os.path.join(code1, 'train.pyc')))
+        self.assertEqual(sorted(os.listdir(self.expdir)), ['run1', 'run2'])
+
+
+
+class DispatchRunsTest(unittest.TestCase):
+    def test_stops_at_first_failure(self):
+        dispatched = []
+
+        def dispatch_run(name, *_):
+            dispatched.append(name)
+            if name == 'run0':
+                raise RuntimeError('submit failed')
+
+        runs = [('run{}'.format(i),) for i in range(20)]
+        with mock.patch.object(runx, 'dispatch_run', dispatch_run), \
+                mock.patch.object(runx, 'get_cfg', return_value=1), \
+                mock.patch.object(runx.args, 'interactive', False):
+            with self.assertRaises(RuntimeError):
+                runx.dispatch_runs(runs, None, None, None, False)
+
+        # the single worker may already have picked up the next run, but
+        # the rest of the queue is cancelled
+        self.assertLessEqual(len(dispatched), 2)
+        self.assertEqual(dispatched[0], 'run0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,8 @@
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
 import utils
 
@@ -42,5 +46,105 @@ class UtilsTest(unittest.TestCase):
         self.assertTrue(post_hook_called[0])
 
 
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config_fn = os.path.join(self.test_dir, '.runx')
+        self.write_config('LOGROOT: /logs\n', 1000)
+
+        # keep the pickled entries out of ~/.cache and count the real parses
+        cache_dir = os.path.join(self.test_dir, 'cache')
+        self.parses = []
+        load_yaml = utils.load_yaml
+
+        def counting_load_yaml(fp):
+            self.parses.append(fp.name)
+            return load_yaml(fp)
+
+        patches = [
+            mock.patch.object(utils, '_CACHE_DIR', cache_dir),
+            mock.patch.object(utils, '_config_cache', {}),
+            mock.patch.object(utils, 'load_yaml', counting_load_yaml),
+            mock.patch.dict(os.environ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        os.environ.pop('RUNX_NO_CACHE', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def write_config(self, text, mtime):
+        with open(self.config_fn, 'w') as fp:
+            fp.write(text)
+        os.utime(self.config_fn, (mtime, mtime))
+
+    def load(self):
+        with open(self.config_fn, 'rb') as fp:
+            return utils.load_config_yaml(fp)
+
+    def test_cached(self):
+        config = self.load()
+        self.assertEqual(config, {'LOGROOT': '/logs'})
+
+        # callers may modify what they get back
+        config['LOGROOT'] = '/elsewhere'
+        self.assertEqual(self.load(), {'LOGROOT': '/logs'})
+        self.assertEqual(len(self.parses), 1)
+
+        # a new process still has the pickled copy
+        utils._config_cache.clear()
+        self.assertEqual(self.load(), {'LOGROOT': '/logs'})
+        self.assertEqual(len(self.parses), 1)
+
+    def test_stamp_change(self):
+        self.load()
+
+        # same size, different mtime
+        self.write_config('LOGROOT: /logz\n', 2000)
+        self.assertEqual(self.load(), {'LOGROOT': '/logz'})
+        self.assertEqual(len(self.parses), 2)
+
+        # same mtime, different size
+        self.write_config('LOGROOT: /logs2\n', 2000)
+        utils._config_cache.clear()
+        self.assertEqual(self.load(), {'LOGROOT': '/logs2'})
+        self.assertEqual(len(self.parses), 3)
+
+    def test_no_cache(self):
+        os.environ['RUNX_NO_CACHE'] = '1'
+        self.assertEqual(self.load(), {'LOGROOT': '/logs'})
+        self.assertEqual(self.load(), {'LOGROOT': '/logs'})
+        self.assertEqual(len(self.parses), 2)
+        self.assertFalse(os.path.exists(utils._CACHE_DIR))
+
+    def test_invalidate(self):
+        self.load()
+        self.assertEqual(len(os.listdir(utils._CACHE_DIR)), 1)
+
+        # rewritten without changing the stamp, only invalidating notices
+        self.write_config('LOGROOT: /logz\n', 1000)
+        self.assertEqual(self.load(), {'LOGROOT': '/logs'})
+
+        utils.invalidate_config_cache()
+        self.assertEqual(os.listdir(utils._CACHE_DIR), [])
+        self.assertEqual(self.load(), {'LOGROOT': '/logz'})
+        self.assertEqual(len(self.parses), 2)
+
+    def test_failed_cache_write(self):
+        # a failed rename is ignored, a failed pickle is raised, but neither
+        # leaves a temp file behind
+        with mock.patch.object(os, 'replace', side_effect=OSError):
+            self.assertEqual(self.load(), {'LOGROOT': '/logs'})
+        self.assertEqual(os.listdir(utils._CACHE_DIR), [])
+
+        utils._config_cache.clear()
+        with mock.patch('pickle.dump', side_effect=TypeError):
+            with self.assertRaises(TypeError):
+                self.load()
+        self.assertEqual(os.listdir(utils._CACHE_DIR), [])
+
+
 if __name__ == '__main__':
     unittest.main()
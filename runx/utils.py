@@ -28,25 +28,51 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
 import os
-import yaml
+import re
+import sys
+import copy
 import shlex
 import json
+import threading
 from warnings import warn
 
 import subprocess
-from subprocess import call, getoutput, DEVNULL
 from .config import cfg
 
 
-def exec_cmd(cmd):
+_HOME = os.path.expanduser('~')
+_GLOBAL_CONFIG_FN = '{}/.config/runx.yml'.format(_HOME)
+# Parsed global config files are cached here, set RUNX_NO_CACHE to disable
+_CACHE_DIR = os.path.join(_HOME, '.cache', 'runx')
+# In-process copy of the parsed config files, keyed on path
+_config_cache = {}
+
+
+def exec_cmd(cmd, cwd=None):
     """
     Execute a command and print stderr/stdout to the console
+
+    :cmd: either a string, which is run by the shell, or an argv list, which
+          is executed directly without starting a shell
+    :cwd: (optional) directory to run the command in
     """
-    print(cmd)
-    result = subprocess.run(cmd, stderr=subprocess.PIPE, shell=True)
-    if result.stderr:
-        message = result.stderr.decode("utf-8")
-        print(message)
+    shell = isinstance(cmd, str)
+    print(cmd if shell else ' '.join(shlex.quote(arg) for arg in cmd))
+    try:
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, shell=shell,
+                                cwd=cwd)
+    except FileNotFoundError as e:
+        # Without a shell, a missing executable raises instead of being
+        # reported on stderr
+        print(e)
+        return
+    # Relay stderr as it arrives instead of holding all of it in memory
+    # until the command exits
+    with proc.stderr:
+        for line in proc.stderr:
+            sys.stderr.write(line.decode('utf-8', 'replace'))
+            sys.stderr.flush()
+    proc.wait()
 
 
 trn_names = ('trn', 'train', 'training')
@@ -61,35 +87,138 @@ def get_cfg(key):
         return None
 
 
+_MISSING = object()
+
+
 def read_config_item(config, key, optional=True):
-    if key in config:
-        return config[key]
+    val = config.get(key, _MISSING)
+    if val is not _MISSING:
+        return val
     elif optional:
         return None
     else:
-        raise f'can\'t find {key} in config'
+        raise KeyError(f'can\'t find {key} in config')
+
+
+def load_yaml(fp):
+    """
+    Parse yaml from an open file.
+
+    yaml is imported here rather than at module scope so that users of logx,
+    which imports this module, don't pay for it unless a config is read.
+    The libyaml-backed loader is preferred when it's available.
+    """
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(fp, Loader=loader)
 
 
 def read_config_file(args=None):
     local_config_fn = './.runx'
-    home = os.path.expanduser('~')
-    global_config_fn = '{}/.config/runx.yml'.format(home)
-
-    if args is not None and hasattr(args, 'config_file') and \
-       args.config_file is not None and \
-       os.path.isfile(args.config_file):
-        config_fn = args.config_file
-    elif os.path.isfile(local_config_fn):
-        config_fn = local_config_fn
-    elif os.path.exists(global_config_fn):
-        config_fn = global_config_fn
-    else:
-        raise('can\'t find file ./.runx or ~/.config/runx.yml config files')
-    if 'FullLoader' in dir(yaml):
-        global_config = yaml.load(open(config_fn), Loader=yaml.SafeLoader)
-    else:
-        global_config = yaml.safe_load(open(config_fn))
-    return global_config
+
+    # Opening the file doubles as the existence check, so that in the common
+    # case only a single filesystem round trip is needed to locate the config
+    config_file = getattr(args, 'config_file', None)
+    for config_fn in (config_file, local_config_fn, _GLOBAL_CONFIG_FN):
+        if config_fn is None:
+            continue
+        try:
+            fp = open(config_fn, 'rb')
+        except OSError:
+            continue
+        with fp:
+            return load_config_yaml(fp)
+
+    raise FileNotFoundError(
+        'can\'t find file ./.runx or ~/.config/runx.yml config files')
+
+
+def load_config_yaml(fp):
+    '''
+    Parse an open config file, reusing an already parsed copy from earlier
+    in this process, or a pickled copy of the result from a previous
+    invocation, if the file hasn't changed since then.
+
+    The cache entries are keyed on the path of the config file and are only
+    considered valid if the recorded mtime and size still match. Callers
+    modify the returned config, so they always get their own copy.
+    '''
+    if os.environ.get('RUNX_NO_CACHE'):
+        return load_yaml(fp)
+
+    st = os.fstat(fp.fileno())
+    stamp = (st.st_mtime_ns, st.st_size)
+    abs_fn = os.path.abspath(fp.name)
+
+    cached = _config_cache.get(abs_fn)
+    if cached is not None and cached[0] == stamp:
+        return copy.deepcopy(cached[1])
+
+    config = _load_pickled_config(fp, abs_fn, stamp)
+    _config_cache[abs_fn] = (stamp, config)
+    return copy.deepcopy(config)
+
+
+def invalidate_config_cache():
+    """
+    Drop all cached config files, both in-process and pickled, e.g. for a
+    config that was rewritten within the mtime granularity of the fs
+    """
+    _config_cache.clear()
+    try:
+        cache_fns = os.listdir(_CACHE_DIR)
+    except OSError:
+        return
+    for fn in cache_fns:
+        if fn.endswith('.pkl'):
+            try:
+                os.remove(os.path.join(_CACHE_DIR, fn))
+            except OSError:
+                pass
+
+
+def _load_pickled_config(fp, abs_fn, stamp):
+    # Only needed when a config is read, see load_yaml
+    import hashlib
+    import pickle
+    import tempfile
+
+    path_hash = hashlib.sha1(abs_fn.encode('utf-8'))
+    cache_fn = os.path.join(_CACHE_DIR, path_hash.hexdigest() + '.pkl')
+
+    try:
+        with open(cache_fn, 'rb') as cache_fp:
+            cached_stamp, config = pickle.load(cache_fp)
+        if cached_stamp == stamp:
+            return config
+    except Exception:
+        # missing or unreadable cache entry, just parse the file
+        pass
+
+    config = load_yaml(fp)
+
+    # Write atomically so that concurrent runx invocations never see a
+    # partially written cache entry
+    tmp_fn = None
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(dir=_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache_fp:
+            pickle.dump((stamp, config), cache_fp,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fn, cache_fn)
+        tmp_fn = None
+    except OSError:
+        pass
+    finally:
+        # don't leave the temp file behind, whatever went wrong
+        if tmp_fn is not None:
+            try:
+                os.remove(tmp_fn)
+            except OSError:
+                pass
+
+    return config
 
 
 def read_config(args):
@@ -121,7 +250,8 @@ def read_config(args):
     # Merge experiment settings into the global configuration.
     # This allows an experiment yaml to override the settings in the .runx
     if hasattr(args, 'exp_yml'):
-        exp_config = yaml.load(open(args.exp_yml), Loader=yaml.SafeLoader)
+        with open(args.exp_yml, 'rb') as fp:
+            exp_config = load_yaml(fp)
 
         for k, v in exp_config.items():
             if k in experiment:
@@ -151,6 +281,22 @@ def read_config(args):
         if 'ngc' in cfg.FARM:
             cfg.NGC_LOGROOT = read_config_item(experiment, 'NGC_LOGROOT')
             cfg.WORKSPACE = read_config_item(experiment, 'WORKSPACE')
+    if 'DISPATCH_WORKERS' in experiment:
+        workers = experiment['DISPATCH_WORKERS']
+        try:
+            num_workers = int(workers)
+        except (TypeError, ValueError):
+            num_workers = 0
+        if num_workers < 1:
+            raise ValueError(f'DISPATCH_WORKERS must be a positive integer, '
+                             f'got {workers!r}')
+        cfg.DISPATCH_WORKERS = num_workers
+    if 'LINK_CODE' in experiment:
+        link_code = experiment['LINK_CODE']
+        if not isinstance(link_code, bool):
+            raise ValueError(f'LINK_CODE must be true or false, '
+                             f'got {link_code!r}')
+        cfg.LINK_CODE = link_code
 
     return experiment
 
@@ -160,28 +306,60 @@ def get_logroot():
     return read_config_item(global_config, 'LOGROOT')
 
 
-def get_bigfiles(root):
-    output = getoutput('find {} -size +100k'.format(root))
-    if len(output):
-        bigfiles = output.split('\n')
-        return bigfiles
-    else:
-        return []
+# files larger than this, in bytes, are left out of code.tgz
+_BIGFILE_SIZE = 100 * 1024
+# skip over non-sourcecode items when saving code
+_CODE_EXCLUDES = ['*.pth', '*.jpg', '*.jpeg', '*.pyc', '*.so', '*.o',
+                  '*.git', '__pycache__', '*~']
 
 
 def save_code(logdir, coderoot):
-    zip_outfile = os.path.join(logdir, 'code.tgz')
+    # tarfile, fnmatch and shutil are only needed here, so logx users that
+    # never save code don't pay to import them
+    import fnmatch
+    import shutil
+    import tarfile
 
-    # skip over non-sourcecode items
-    exclude_list = ['*.pth', '*.jpg', '*.jpeg', '*.pyc', '*.so', '*.o',
-                    '*.git', '__pycache__', '*~']
-    bigfiles = get_bigfiles(coderoot)
-    exclude_str = ''
-    for ex in exclude_list + bigfiles:
-        exclude_str += ' --exclude=\'{}\''.format(ex)
+    zip_outfile = os.path.join(logdir, 'code.tgz')
 
-    cmd = 'tar -czvf {} {} {}'.format(zip_outfile, exclude_str, coderoot)
-    call(shlex.split(cmd), stdout=DEVNULL, stderr=DEVNULL)
+    # All of the globs are combined into a single regex since it's applied
+    # to every file
+    exclude_re = re.compile('|'.join(fnmatch.translate(ex)
+                                     for ex in _CODE_EXCLUDES))
+
+    def exclude_from_code(tarinfo):
+        if exclude_re.match(os.path.basename(tarinfo.name)):
+            return None
+        # Big files are caught here from the size tarfile has already
+        # stat'ed, rather than by walking the tree a second time
+        if tarinfo.isfile() and tarinfo.size > _BIGFILE_SIZE:
+            return None
+        return tarinfo
+
+    # Level 1 is several times faster than gzip's default and the archive
+    # is only a snapshot of the sources. pigz, if installed, also spreads
+    # the compression over all cores.
+    pigz = shutil.which('pigz')
+    try:
+        if pigz is None:
+            with tarfile.open(zip_outfile, 'w:gz', compresslevel=1) as tar:
+                tar.add(coderoot, filter=exclude_from_code)
+            return
+
+        with open(zip_outfile, 'wb') as outfile:
+            proc = subprocess.Popen([pigz, '-1'], stdin=subprocess.PIPE,
+                                    stdout=outfile)
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                    tar.add(coderoot, filter=exclude_from_code)
+            finally:
+                proc.stdin.close()
+                proc.wait()
+        if proc.returncode:
+            warn(f'Failed to save code to {zip_outfile}: '
+                 f'pigz exited with {proc.returncode}')
+    except (OSError, tarfile.TarError) as e:
+        warn(f'Failed to save code to {zip_outfile}: {e}')
 
 
 def save_hparams(hparams, logdir):
@@ -190,26 +368,45 @@ def save_hparams(hparams, logdir):
     """
     json_fn = os.path.join(logdir, 'hparams.json')
 
-    if os.path.isfile(json_fn):
+    if os.path.exists(json_fn):
         return
 
-    with open(json_fn, 'w') as outfile:
-        json.dump(hparams, outfile, indent=4)
-
+    # The json is written to a private temp file and then linked into place,
+    # so that readers such as sumx never see a partially written file, and an
+    # hparams.json that appeared in the meantime is never replaced
+    tmp_fn = '{}.{}.{}.tmp'.format(json_fn, os.getpid(), threading.get_ident())
+    fd = os.open(tmp_fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(json.dumps(hparams, indent=4).encode('utf-8'))
+        try:
+            os.link(tmp_fn, json_fn)
+        except FileExistsError:
+            pass
+        except OSError:
+            # filesystem without hardlinks
+            if not os.path.exists(json_fn):
+                os.replace(tmp_fn, json_fn)
+    finally:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
 
-class _CallableProxy:
-    def __init__(self, real_callable, post_hook=None):
-        self.real_callable = real_callable
-        self.post_hook = post_hook
 
-    def __call__(self, *args, **kwargs):
-        ret_val = self.real_callable(*args, **kwargs)
+def _throw_away(*args, **kwargs):
+    pass
 
-        if self.post_hook is not None:
-            self.post_hook()
 
+def _with_post_hook(real_callable, post_hook):
+    """
+    Wrap real_callable so that post_hook is invoked after each call
+    """
+    def call(*args, **kwargs):
+        ret_val = real_callable(*args, **kwargs)
+        post_hook()
         return ret_val
 
+    return call
+
 
 class ConditionalProxy:
     """
@@ -250,27 +447,54 @@ class ConditionalProxy:
     when `condition == True`.
     """
 
+    def __new__(cls, real_object, condition, post_hook=None):
+        # Every proxy whose condition is false behaves the same, so they all
+        # share one instance. On non-rank0 processes this avoids building
+        # the no-op lookups again for each proxy.
+        if not condition:
+            return _NULL_PROXY
+        return super().__new__(cls)
+
     def __init__(self, real_object, condition, post_hook=None):
         self.real_object = real_object
         self.condition = condition
         self.post_hook = post_hook
 
-    @staticmethod
-    def _throw_away(*args, **kwargs):
-        pass
-
     def __getattr__(self, name):
+        # `__getattr__` is only called when `name` is missing from the
+        # instance dict, so whatever we resolve here is stored there and
+        # subsequent lookups become plain attribute accesses.
         if not self.condition:
             # When `self.condition == False`, then we want to return a function
             # that can take any form of arguments, and does nothing. This works
             # under the assumption that the only API interface for the
             # dependent object is function, e.g. this would be awkward if the
             # caller was trying to access a member variable.
-            return ConditionalProxy._throw_away
+            fn = _throw_away
+        else:
+            fn = getattr(self.real_object, name)
+
+            # Wrap the return function so that we can invoke the
+            # `self.post_hook`, if specified, after the real function
+            # executes.
+            if self.post_hook is not None:
+                fn = _with_post_hook(fn, self.post_hook)
+
+        self.__dict__[name] = fn
+        return fn
+
+
+class _NullProxy(ConditionalProxy):
+    """
+    The shared stand-in for a `ConditionalProxy` whose condition is false.
+    It keeps no reference to the real object or post_hook.
+    """
+    real_object = None
+    condition = False
+    post_hook = None
+
+    def __init__(self, *args, **kwargs):
+        pass
 
-        real_fn = getattr(self.real_object, name)
 
-        # Wrap the return function in a `_CallableProxy` so that we can
-        # invoke the `self.post_hook`, if specified, after the real function
-        # executes.
-        return _CallableProxy(real_fn, self.post_hook)
+_NULL_PROXY = object.__new__(_NullProxy)
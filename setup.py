@@ -7,13 +7,18 @@ with open("runx/_version.py") as fp:
     exec(fp.read(), None, _locals)
     version = _locals["__version__"]
 
-with open("README.md", "r") as fh:
-    long_description = fh.read()
+parent = Path(__file__).resolve().parent
 
-with open('requirements.txt') as f:
-    requirements = f.read().splitlines()
+long_description = (parent / 'README.md').read_text(encoding='utf-8')
+
+requirements_txt = (parent / 'requirements.txt').read_text(encoding='utf-8')
+requirements = []
+for line in requirements_txt.splitlines():
+    line = line.strip()
+    # skip blank and comment lines
+    if line and not line.startswith('#'):
+        requirements.append(line)
 
-parent = Path(__file__).resolve().parent
 setup(
     name="runx",
     version=version,
@@ -30,5 +35,7 @@ setup(
         "Operating System :: OS Independent",
     ],
     install_requires=requirements,
+    # orjson speeds up reading the json files of each run in sumx
+    extras_require={'fast': ['orjson']},
     python_requires='>=3.6',
 )